@@ -5,6 +5,7 @@ This module provides reach task specific operations.
 from __future__ import annotations
 
 import pickle
+import warnings
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -57,7 +58,9 @@ class ActionLabels:
     precue_rewarded_right = 1 << 15
     tracking_fail_left = 1 << 16  # Motion tracking failed to get reach trajectory
     tracking_fail_right = 1 << 17
-    long_reach_duration_left = 1 << 17
+    # Was 1 << 17 which clashed with tracking_fail_right. 29 is the first free bit so no
+    # existing label values change.
+    long_reach_duration_left = 1 << 29
     long_reach_duration_right = 1 << 18
     clean = clean_left | clean_right
     multi = multi_left | multi_right
@@ -96,6 +99,25 @@ class Events:
     subsequent_slit_out = 1 << 8
 
 
+def _check_label_bits(labels):
+    """
+    Raise an error if any two of the single-bit labels of a label class share a bit.
+    Combined labels (those with more than one bit set) are ignored.
+    """
+    seen = {}
+    for name, value in vars(labels).items():
+        if name.startswith("_") or value & (value - 1):
+            continue
+        if value in seen:
+            cls = labels.__name__
+            raise PixelsError(f"{cls}.{name} uses the same bit as {cls}.{seen[value]}.")
+        seen[value] = name
+
+
+_check_label_bits(ActionLabels)
+_check_label_bits(Events)
+
+
 # These are used to convert the trial data into Actions and Events
 _side_map = {
     Targets.LEFT: "left",
@@ -108,6 +130,60 @@ _action_map = {
     Outcomes.INCORRECT: "incorrect",
 }
 
+# Action label for each (spout, outcome) pair, so trials don't need a getattr each
+_trial_codes = {
+    (spout, outcome): np.uint32(
+        getattr(ActionLabels, f"{_action_map[outcome]}_{_side_map[spout]}")
+    )
+    for spout in _side_map
+    for outcome in _action_map
+}
+
+
+def _combine_labels(actions, events):
+    """
+    Put the separate action and event arrays into the (N, 2) uint64 layout that
+    action labels are saved in, without an intermediate copy.
+    """
+    action_labels = np.empty((len(actions), 2), dtype=np.uint64)
+    action_labels[:, 0] = actions
+    action_labels[:, 1] = events
+    return action_labels
+
+
+# https://bryceboe.com/2006/10/23/line-segment-intersection-algorithm
+# Points lie on opposite sides of a line when exactly one of their cross products is
+# positive. As with the counter-clockwise test in the link, a zero cross product does
+# not count as positive, so a point exactly on the line sides with the negative ones.
+def _cross(ax, ay, bx, by, cx, cy):
+    return (cy - ay) * (bx - ax) - (by - ay) * (cx - ax)
+
+
+def _first_crossing(hx, hy, p1x, p1y, p2x, p2y):
+    """
+    Test every segment of a hand trajectory, given as x and y coordinate arrays, against
+    the line from p1 to p2 and return the position of the start of the last segment that
+    crosses it. If no segment crosses the line, 0 is returned.
+    """
+    # Cast the line to the trajectory's dtype so float32 coordinates aren't upcast
+    p1x, p1y, p2x, p2y = np.array([p1x, p1y, p2x, p2y], dtype=hx.dtype)
+
+    # Test every segment at once
+    sx, sy = hx[:-1], hy[:-1]
+    ex, ey = hx[1:], hy[1:]
+    hits = (
+        (
+            (_cross(p1x, p1y, sx, sy, ex, ey) > 0) !=
+            (_cross(p2x, p2y, sx, sy, ex, ey) > 0)
+        ) & (
+            (_cross(p1x, p1y, p2x, p2y, sx, sy) > 0) !=
+            (_cross(p1x, p1y, p2x, p2y, ex, ey) > 0)
+        )
+    )
+    if not hits.any():
+        return 0
+    return len(hits) - 1 - hits[::-1].argmax()
+
 
 
 class Reach(Behaviour):
@@ -118,7 +194,10 @@ class Reach(Behaviour):
                 + 0.5 * behavioural_data["/'NpxlSync_Signal'/'0'"]
 
         behavioural_data = signal.binarise(behavioural_data)
-        action_labels = np.zeros((len(behavioural_data), 2), dtype=np.uint64)
+        # Actions and events are kept as separate arrays while they are being built.
+        # All of the label bits fit into 32 bits.
+        actions = np.zeros(len(behavioural_data), dtype=np.uint32)
+        events = np.zeros(len(behavioural_data), dtype=np.uint32)
 
         try:
             cue_leds = behavioural_data["/'ReachLEDs'/'0'"].values
@@ -126,10 +205,13 @@ class Reach(Behaviour):
             # some early recordings still used this key
             cue_leds = behavioural_data["/'Back_Sensor'/'0'"].values
 
-        led_onsets = np.where((cue_leds[:-1] == 0) & (cue_leds[1:] == 1))[0]
-        led_offsets = np.where((cue_leds[:-1] == 1) & (cue_leds[1:] == 0))[0]
-        action_labels[led_onsets, 1] += Events.led_on
-        action_labels[led_offsets, 1] += Events.led_off
+        # Binarised channels are already int8 so a single diff gives +1 at onsets and -1
+        # at offsets
+        edges = np.diff(cue_leds)
+        led_onsets = np.flatnonzero(edges == 1)
+        led_offsets = np.flatnonzero(edges == -1)
+        np.bitwise_or.at(events, led_onsets, np.uint32(Events.led_on))
+        np.bitwise_or.at(events, led_offsets, np.uint32(Events.led_off))
         metadata = self.metadata[rec_num]
 
         # QA: Check that the JSON and TDMS data have the same number of trials
@@ -183,29 +265,32 @@ class Reach(Behaviour):
 
         # QA: Check that the cue durations (mostly) match between JSON and TDMS data
         # This compares them at 10s of milliseconds resolution
+        trials = metadata['trials']
+        starts = np.fromiter((t['start'] for t in trials), dtype=np.float64, count=len(trials))
+        ends = np.fromiter((t['end'] for t in trials), dtype=np.float64, count=len(trials))
         cue_durations_tdms = (led_offsets - led_onsets) / 100
-        cue_durations_json = np.array(
-            [t['end'] - t['start'] for t in metadata['trials']]
-        ) * 10
-        error = sum(
-            (cue_durations_tdms - cue_durations_json).round() != 0
-        ) / len(led_onsets)
+        cue_durations_json = (ends - starts) * 10
+        mismatches = np.count_nonzero(np.rint(cue_durations_tdms - cue_durations_json))
+        error = mismatches / len(led_onsets)
         if error > 0.05:
             raise PixelsError(
                 f"{self.name}: Mantis and Raspberry Pi behavioural data have mismatching trial data."
             )
 
-        return behavioural_data, action_labels, led_onsets
+        return behavioural_data, actions, events, led_onsets
 
     def _extract_action_labels(self, rec_num, behavioural_data, plot=False):
-        behavioural_data, action_labels, led_onsets = self._preprocess_behaviour(rec_num, behavioural_data)
+        behavioural_data, actions, events, led_onsets = self._preprocess_behaviour(
+            rec_num, behavioural_data
+        )
 
-        for i, trial in enumerate(self.metadata[rec_num]["trials"]):
-            side = _side_map[trial["spout"]]
-            outcome = trial["outcome"]
-            if outcome in _action_map:
-                action = _action_map[trial["outcome"]]
-                action_labels[led_onsets[i], 0] += getattr(ActionLabels, f"{action}_{side}")
+        codes = [
+            _trial_codes.get((t["spout"], t["outcome"]))
+            for t in self.metadata[rec_num]["trials"]
+        ]
+        labelled = np.array([c is not None for c in codes], dtype=bool)
+        codes = np.fromiter((c for c in codes if c is not None), dtype=np.uint32)
+        np.bitwise_or.at(actions, led_onsets[labelled], codes)
 
         if plot:
             plt.clf()
@@ -215,12 +300,12 @@ class Reach(Behaviour):
                 axes[1].plot(behavioural_data["/'Back_Sensor'/'0'"].values)
             else:
                 axes[1].plot(behavioural_data["/'ReachCue_LEDs'/'0'"].values)
-            axes[2].plot(action_labels[:, 0])
-            axes[3].plot(action_labels[:, 1])
-            plt.plot(action_labels[:, 1])
+            axes[2].plot(actions)
+            axes[3].plot(events)
+            plt.plot(events)
             plt.show()
 
-        return action_labels
+        return _combine_labels(actions, events)
 
     def draw_slit_thresholds(self, project: str, force: bool = False):
         """
@@ -314,46 +399,60 @@ class Reach(Behaviour):
             with line_file.open("rb") as f:
                 proj_lines = pickle.load(f)
 
+            # Each line is a (2, 2) array of its two (x, y) end points
             lines[project] = {
-                tt:[pd.Series(p, index=["x", "y"]) for p in points.values()]
+                tt: np.asarray(list(points.values()), dtype=np.float64)
                 for tt, points in proj_lines.items()
             }
 
         action_labels = self.get_action_labels()
         event = Events.led_off
 
-        # https://bryceboe.com/2006/10/23/line-segment-intersection-algorithm
-        def ccw(A, B, C):
-            return (C.y - A.y) * (B.x - A.x) > (B.y - A.y) * (C.x - A.x)
+        # Align all correct trials once per camera, then pick out the left and right
+        # trials from these below rather than aligning each side separately
+        num_correct = sum(
+            np.count_nonzero(np.bitwise_and(labels[:, 0], ActionLabels.correct))
+            for labels in action_labels
+        )
+        trajectories = {}
+        for project in projects:
+            proj_data = self.align_trials(
+                ActionLabels.correct,
+                event,
+                "motion_tracking",
+                duration=6,
+                dlc_project=project,
+            )
+            proj_traj, = check_scorers(proj_data)
+            # Trials are picked out by position, which only works if none were skipped
+            if proj_traj.columns.get_level_values("trial").nunique() != num_correct:
+                raise PixelsError(
+                    f"{self.name}: {project} motion tracking could not be aligned to "
+                    "every correct trial."
+                )
+            trajectories[project] = get_reach_trajectories(proj_traj)[0]
 
         for tt, action in enumerate(
             (ActionLabels.correct_left, ActionLabels.correct_right),
         ):
-            data = {}
-            trajectories = {}
-
-            for project in projects:
-                proj_data = self.align_trials(
-                    action,
-                    event,
-                    "motion_tracking",
-                    duration=6,
-                    dlc_project=project,
-                )
-                proj_traj, = check_scorers(proj_data)
-                data[project] = proj_traj
-                trajectories[project] = get_reach_trajectories(proj_traj)[0]
+            # Aligned trials are numbered across all recordings
+            offset = 0
 
             for rec_num, recording in enumerate(self.files):
                 actions = action_labels[rec_num][:, 0]
                 events = action_labels[rec_num][:, 1]
-                trial_starts = np.where(np.bitwise_and(actions, action))[0]
-
-                for t, start in enumerate(trial_starts):
-                    centre = np.where(np.bitwise_and(events[start:start + 6000], event))[0]
-                    if len(centre) == 0:
+                correct_starts = np.where(np.bitwise_and(actions, ActionLabels.correct))[0]
+                trials = np.where(np.bitwise_and(actions[correct_starts], action))[0]
+
+                for trial in trials:
+                    t = offset + trial
+                    start = correct_starts[trial]
+                    # argmax stops at the first match without building an index array
+                    matches = np.bitwise_and(events[start:start + 6000], event).astype(bool)
+                    first = matches.argmax()
+                    if not matches[first]:
                         raise PixelsError('Action labels probably miscalculated')
-                    centre = start + centre[0]
+                    centre = start + first
                     # centre is index of this rec's grasp
                     onsets = []
                     for project, motion in trajectories.items():
@@ -371,29 +470,20 @@ class Reach(Behaviour):
                             if x_r > x_l:
                                 hand = left_hand
 
-                        segments = zip(
-                            hand.iloc[::-1].iterrows(),
-                            hand.iloc[-2::-1].iterrows(),
-                        )
-
-                        for (end, ptend), (start, ptsta) in segments:
-                            if (
-                                ccw(pt1, ptsta, ptend) != ccw(pt2, ptsta, ptend) and
-                                ccw(pt1, pt2, ptsta) != ccw(pt1, pt2, ptend)
-                            ):
-                                # These lines intersect
-                                #print("x from ", ptsta.x, " to ", ptend.x)
-                                break
-                        #if ptend.y > 300 or ptsta.y > 300:
-                        #    assert 0
-                        onsets.append(start)
+                        hx = hand["x"].to_numpy()
+                        hy = hand["y"].to_numpy()
+                        crossing = _first_crossing(hx, hy, pt1[0], pt1[1], pt2[0], pt2[1])
+                        onsets.append(hand.index[crossing])
 
                     onset = max(onsets)
                     onset_timepoint = round(centre + (onset * 1000))
                     events[onset_timepoint] |= Events.reach_onset
 
-                output = self.processed / recording['action_labels']
-                np.save(output, action_labels[rec_num])
+                offset += len(correct_starts)
+
+        for rec_num, recording in enumerate(self.files):
+            output = self.processed / recording['action_labels']
+            np.save(output, action_labels[rec_num], allow_pickle=False)
 
 
 global _roi_helper
@@ -402,7 +492,9 @@ _roi_helper = None
 
 class VisualOnly(Reach):
     def _extract_action_labels(self, behavioural_data, plot=False):
-        behavioural_data, action_labels, led_onsets = self._preprocess_behaviour(behavioural_data)
+        behavioural_data, actions, events, led_onsets = self._preprocess_behaviour(
+            behavioural_data
+        )
 
         for i, trial in enumerate(self.metadata["trials"]):
             label = "naive_" + _side_map[trial["spout"]] + "_"
@@ -410,9 +502,9 @@ class VisualOnly(Reach):
                 label += "long"
             else:
                 label += "short"
-            action_labels[led_onsets[i], 0] += getattr(ActionLabels, label)
+            actions[led_onsets[i]] |= getattr(ActionLabels, label)
 
-        return action_labels
+        return _combine_labels(actions, events)
 
 
 def get_reach_velocities(*dfs: pd.DataFrame) -> tuple[pd.DataFrame]:
@@ -422,15 +514,16 @@ def get_reach_velocities(*dfs: pd.DataFrame) -> tuple[pd.DataFrame]:
     results = []
 
     for df in dfs:
-        df = df.copy()
-        deltas = np.square(df.iloc[1:].values - df.iloc[:-1].values)
-        # Fill the start with a row of zeros - each value is delta in previous 1 ms
-        deltas = np.append(np.zeros((1, deltas.shape[1])), deltas, axis=0)
-        deltas = np.sqrt(deltas[:, ::2] + deltas[:, 1::2])
-        df = df.drop([c for c in df.columns if "y" in c], axis=1)
-        df = df.rename({"x": "delta"}, axis='columns')
-        df.values[:] = deltas
-        results.append(df)
+        values = df.to_numpy()
+        # Start with a row of zeros - each value is delta in previous 1 ms
+        deltas = np.zeros((values.shape[0], values.shape[1] // 2), dtype=values.dtype)
+        np.hypot(
+            values[1:, ::2] - values[:-1, ::2],
+            values[1:, 1::2] - values[:-1, 1::2],
+            out=deltas[1:],
+        )
+        result = pd.DataFrame(deltas, index=df.index, columns=df.columns[::2])
+        results.append(result.rename({"x": "delta"}, axis='columns'))
 
     return tuple(results)
 
@@ -444,6 +537,13 @@ def get_reach_trajectories(*dfs: pd.DataFrame) -> tuple[pd.DataFrame]:
     bodyparts = get_body_parts(dfs[0])
     right_paw = [p for p in bodyparts if p.startswith("right")]
     left_paw = [p for p in bodyparts if p.startswith("left")]
+    coords = dfs[0].columns.get_level_values("coords").unique().sort_values()
+
+    # Only the paw columns are gathered, with the left paw's body parts first. These
+    # (bodypart, coord) labels are the same for every trial so are only built once.
+    paw_columns = pd.MultiIndex.from_product([left_paw + right_paw, coords])
+    left = slice(0, len(left_paw))
+    right = slice(len(left_paw), None)
 
     trajectories_l = []
     trajectories_r = []
@@ -462,19 +562,33 @@ def get_reach_trajectories(*dfs: pd.DataFrame) -> tuple[pd.DataFrame]:
             sessions = df.columns.get_level_values("session").unique()
 
         for s in sessions:
-            per_trial_l = []
-            per_trial_r = []
-
-            trials = df[s].columns.get_level_values("trial").unique()
-            for t in trials:
-                tdf = df[s][t]
-                left = pd.concat((tdf[p] for p in left_paw), keys=left_paw)
-                right = pd.concat((tdf[p] for p in right_paw), keys=right_paw)
-                per_trial_l.append(left.groupby(level=1).median())
-                per_trial_r.append(right.groupby(level=1).median())
-
-            per_ses_l.append(pd.concat(per_trial_l, axis=1, keys=trials))
-            per_ses_r.append(pd.concat(per_trial_r, axis=1, keys=trials))
+            ses_df = df[s]
+            trials = ses_df.columns.get_level_values("trial").unique()
+
+            # Gather the values into a (time, trial, bodypart, coord) block so that the
+            # medians for all trials are taken in one go
+            positions = ses_df.columns.get_indexer(
+                pd.MultiIndex.from_tuples(
+                    (t, *part) for t in trials for part in paw_columns
+                )
+            )
+            if (positions < 0).any():
+                raise PixelsError(f"Session {s} is missing paw coordinates for some trials.")
+            block = ses_df.to_numpy()[:, positions].reshape(
+                len(ses_df), len(trials), len(paw_columns) // len(coords), len(coords)
+            )
+            columns = pd.MultiIndex.from_product([trials, coords])
+
+            for paw, per_ses in ((left, per_ses_l), (right, per_ses_r)):
+                with warnings.catch_warnings():
+                    # Trials padded with NaNs at the edges give all-NaN slices
+                    warnings.filterwarnings(
+                        "ignore", "All-NaN slice encountered", RuntimeWarning
+                    )
+                    median = np.nanmedian(block[:, :, paw, :], axis=2)
+                per_ses.append(pd.DataFrame(
+                    median.reshape(len(ses_df), -1), index=ses_df.index, columns=columns,
+                ))
 
         trajectories_l.append(pd.concat(per_ses_l, axis=1, keys=sessions))
         trajectories_r.append(pd.concat(per_ses_r, axis=1, keys=sessions))
@@ -117,8 +117,17 @@ def binarise(data):
 
     """
     if isinstance(data, pd.DataFrame):
+        # Columns are binarised in place, one at a time to keep memory use down, using
+        # NumPy reductions rather than iterating over each Series. Unlike the builtin
+        # min and max used by _binarise_real, these return NaN if a column contains
+        # any NaNs, so such a column becomes all 0s. Callers drop NaN columns first.
         for column in data.columns:
-            data[column] = _binarise_real(data[column])
+            values = data[column].to_numpy()
+            low = values.min()
+            # Constant channels divide by zero, giving NaNs which also become 0s
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = (values - low) / (values.max() - low)
+            data[column] = (values > 0.5).astype(np.int8)
     else:
         data = _binarise_real(data)
 